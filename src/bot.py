@@ -1,25 +1,33 @@
 import asyncio
+import io
 import os
+import re
+import sys
+import time
 import json
-import copy
 import traceback
-import base64
-from functools import wraps
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import partial, wraps
 from email.utils import parseaddr
-from typing import cast, List, Dict, Any, Optional, Union, Callable, Coroutine
+from typing import cast, List, Dict, Set, Tuple, Any, Optional, Union, Callable, Coroutine, Iterator
 
 import fire  # type: ignore
+import orjson
+import pybase64
 import tiktoken
+import uvloop
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode, ChatMemberStatus
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
 from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, InlineKeyboardButton, CallbackQuery, BufferedInputFile, User
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from openai import AsyncOpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
 from openai.types.chat.chat_completion_tool_param import ChatCompletionToolParam
-from transformers import AutoTokenizer  # type: ignore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler  # type: ignore
 
 from src.localization import Localization
@@ -31,6 +39,9 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
 DEFAULT_HISTORY_MAX_TOKENS = 6144
+TOKENIZER_NUM_THREADS = 4
+HF_MESSAGE_TOKENS_OVERHEAD = 4
+TOKEN_COUNTS_CACHE_SIZE = 4096
 DEFAULT_MESSAGE_COUNT_LIMIT = {
     "standard": {"limit": 1000, "interval": 86400},
     "subscribed": {"limit": 1000, "interval": 86400},
@@ -38,6 +49,10 @@ DEFAULT_MESSAGE_COUNT_LIMIT = {
 TEMPERATURE_RANGE = (0.0, 0.5, 0.8, 1.0, 1.2)
 TOP_P_RANGE = (0.8, 0.9, 0.95, 0.98, 1.0)
 DALLE_DAILY_LIMIT = 5
+POLLING_TIMEOUT = 25
+STREAM_EDIT_INTERVAL = 1.0
+STREAM_CHAT_EDIT_INTERVAL = 4.0
+STREAM_CURSOR = " …"
 CONTACT_USERNAME = "YallenGusev"
 START_TEMPLATE = """
 Привет! Я Сайга, бот с разными языковыми моделями.
@@ -80,6 +95,18 @@ START_TEMPLATE = """
 """
 
 IMAGE_PLACEHOLDER = "<image_placeholder>"
+NEWLINES_TRANSLATION = str.maketrans({"\n": " ", "\r": " "})
+IMAGE_MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+}
+NO_TOOLS_MESSAGE_RE = re.compile(
+    r"^\W*(привет|здравствуй|здравствуйте|добрый день|спасибо|благодарю|пока|hi|hello|hey|thanks|thank you|bye)\W*$",
+    re.IGNORECASE,
+)
 
 SUB_PRICE = 500
 SUB_TITLE = 'Покупка подписки в боте "Сайга" на неделю для пользователя {user_id}'
@@ -95,17 +122,47 @@ SUB_DESCRIPTION = """*Покупка подписки в боте 'Сайга' 
 
 ChatMessage = Dict[str, Any]
 ChatMessages = List[ChatMessage]
+TokenCounter = Callable[[ChatMessages], List[int]]
+TextsTokenCounter = Callable[[List[str]], List[int]]
+
+
+@dataclass(slots=True)
+class ModelConfig:
+    client: AsyncOpenAI
+    name: str
+    token_counter: TokenCounter
+    limits: Dict[str, Dict[str, Any]]
+    system_prompt: str = ""
+    params: Optional[Dict[str, Any]] = None
+    history_max_tokens: int = DEFAULT_HISTORY_MAX_TOKENS
+    can_handle_images: bool = False
+    can_handle_tools: bool = False
+    supports_prompt_cache: bool = False
+    can_stream: bool = False
 
 
 class Tokenizer:
-    tokenizers: Dict[str, AutoTokenizer] = dict()
+    tokenizers: Dict[str, Any] = dict()
+    encoding_names: Dict[str, str] = dict()
+    encodings: Dict[str, tiktoken.Encoding] = dict()
 
     @classmethod
-    def get(cls, model_name: str) -> AutoTokenizer:
+    def get(cls, model_name: str) -> Any:
         if model_name not in cls.tokenizers:
-            cls.tokenizers[model_name] = AutoTokenizer.from_pretrained(model_name)
+            from transformers import AutoTokenizer  # type: ignore
+
+            cls.tokenizers[model_name] = AutoTokenizer.from_pretrained(model_name, use_fast=True)
         return cls.tokenizers[model_name]
 
+    @classmethod
+    def get_encoding(cls, model_name: str) -> tiktoken.Encoding:
+        if model_name not in cls.encoding_names:
+            cls.encoding_names[model_name] = tiktoken.encoding_name_for_model(model_name)
+        encoding_name = cls.encoding_names[model_name]
+        if encoding_name not in cls.encodings:
+            cls.encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+        return cls.encodings[encoding_name]
+
 
 def check_admin(func: Callable[..., Coroutine[Any, Any, Any]]) -> Callable[..., Coroutine[Any, Any, Any]]:
     @wraps(func)
@@ -155,29 +212,41 @@ class LlmBot:
         # Клиент
         with open(client_config_path) as r:
             client_config = json.load(r)
-        self.clients = dict()
-        self.model_names = dict()
-        self.can_handle_images = dict()
-        self.can_handle_tools = dict()
-        self.default_prompts = dict()
-        self.default_params = dict()
-        self.history_max_tokens = dict()
-        self.limits = dict()
-        for model_name, config in client_config.items():
-            self.model_names[model_name] = config.pop("model_name")
-            self.can_handle_images[model_name] = config.pop("can_handle_images", False)
-            self.can_handle_tools[model_name] = config.pop("can_handle_tools", False)
-            self.default_prompts[model_name] = config.pop("system_prompt", "")
-            self.history_max_tokens[model_name] = config.pop("history_max_tokens", DEFAULT_HISTORY_MAX_TOKENS)
-            if "params" in config:
-                self.default_params[model_name] = config.pop("params")
-            self.limits[model_name] = config.pop("message_count_limit", DEFAULT_MESSAGE_COUNT_LIMIT)
-            assert "standard" in self.limits[model_name]
-            assert "subscribed" in self.limits[model_name]
-            self.clients[model_name] = AsyncOpenAI(**config)
-        assert self.clients
-        assert self.model_names
-        assert self.default_prompts
+        self.http_client = DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=256, max_keepalive_connections=64),
+        )
+        self.models: Dict[str, ModelConfig] = dict()
+        self.hf_model_names: Set[str] = set()
+        for model_id, config in client_config.items():
+            name = config.pop("model_name")
+            can_handle_images = config.pop("can_handle_images", False)
+            can_handle_tools = config.pop("can_handle_tools", False)
+            supports_prompt_cache = config.pop("supports_prompt_cache", False)
+            can_stream = config.pop("can_stream", False)
+            system_prompt = config.pop("system_prompt", "")
+            history_max_tokens = config.pop("history_max_tokens", DEFAULT_HISTORY_MAX_TOKENS)
+            params = config.pop("params", None)
+            limits = config.pop("message_count_limit", DEFAULT_MESSAGE_COUNT_LIMIT)
+            assert "standard" in limits
+            assert "subscribed" in limits
+            client = AsyncOpenAI(**config, http_client=self.http_client)
+            self.models[model_id] = ModelConfig(
+                client=client,
+                name=name,
+                token_counter=self._build_token_counter(str(client.base_url), name),
+                limits=limits,
+                system_prompt=system_prompt,
+                params=params,
+                history_max_tokens=history_max_tokens,
+                can_handle_images=can_handle_images,
+                can_handle_tools=can_handle_tools,
+                supports_prompt_cache=supports_prompt_cache,
+                can_stream=can_stream,
+            )
+        assert self.models
+        self.default_prompts = {model_id: cfg.system_prompt for model_id, cfg in self.models.items()}
+        self.default_params = {model_id: cfg.params for model_id, cfg in self.models.items() if cfg.params is not None}
 
         self.localization = Localization.load(localization_config_path, "ru")
 
@@ -204,32 +273,39 @@ class LlmBot:
 
         # Клавиатуры
         self.models_kb = InlineKeyboardBuilder()
-        for model_id in self.clients.keys():
+        for model_id in self.models.keys():
             self.models_kb.row(InlineKeyboardButton(text=model_id, callback_data=f"setmodel:{model_id}"))
         self.models_kb.adjust(2)
+        self.models_markup = self.models_kb.as_markup()
 
         self.characters_kb = InlineKeyboardBuilder()
         for char_id in self.characters.keys():
             self.characters_kb.row(InlineKeyboardButton(text=char_id, callback_data=f"setcharacter:{char_id}"))
         self.characters_kb.adjust(2)
+        self.characters_markup = self.characters_kb.as_markup()
 
         self.likes_kb = InlineKeyboardBuilder()
         self.likes_kb.add(InlineKeyboardButton(text="👍", callback_data="feedback:like"))
         self.likes_kb.add(InlineKeyboardButton(text="👎", callback_data="feedback:dislike"))
+        self.likes_markup = self.likes_kb.as_markup()
 
         self.temperature_kb = InlineKeyboardBuilder()
         for value in TEMPERATURE_RANGE:
             self.temperature_kb.add(InlineKeyboardButton(text=str(value), callback_data=f"settemperature:{value}"))
+        self.temperature_markup = self.temperature_kb.as_markup()
 
         self.top_p_kb = InlineKeyboardBuilder()
         for value in TOP_P_RANGE:
             self.top_p_kb.add(InlineKeyboardButton(text=str(value), callback_data=f"settopp:{value}"))
+        self.top_p_markup = self.top_p_kb.as_markup()
 
         self.buy_kb = InlineKeyboardBuilder()
 
         # Бот
         self.bot = Bot(token=bot_token, default=DefaultBotProperties(parse_mode=None))
         self.bot_info: Optional[User] = None
+        self.bot_mention: Optional[str] = None
+        self.tokenizer_tasks: Dict[str, asyncio.Task[Any]] = dict()
         self.dp = Dispatcher()
         self.dp.message.register(self.start, Command("start"))
         self.dp.message.register(self.start, Command("help"))
@@ -268,25 +344,33 @@ class LlmBot:
             with open(yookassa_config_path) as r:
                 config = json.load(r)
                 self.yookassa = YookassaHandler(**config)
+        self.buy_markup = self.buy_kb.as_markup()
+        self.sub_limits = self._get_limits()
+        self.sub_description = SUB_DESCRIPTION.format(sub_limits=self.sub_limits, price=SUB_PRICE)
 
     async def start_polling(self) -> None:
+        if sys.version_info >= (3, 12):
+            asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+        for model_name in self.hf_model_names:
+            self._load_tokenizer(model_name)
         self.scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
         if self.yookassa is not None:
             self.scheduler.add_job(self.yookassa_check_payments, trigger="interval", seconds=30)
         self.scheduler.start()
         self.bot_info = await self.bot.get_me()
-        await self.dp.start_polling(self.bot)
+        assert self.bot_info.username
+        self.bot_mention = "@" + self.bot_info.username
+        await self.dp.start_polling(self.bot, polling_timeout=POLLING_TIMEOUT)
 
     async def start(self, message: Message) -> None:
         assert message.from_user
         user_id = message.from_user.id
         chat_id = message.chat.id
-        self.db.create_conv_id(chat_id)
+        await asyncio.to_thread(self.db.create_conv_id, chat_id)
         model = self.db.get_current_model(chat_id)
-        remaining_count = self._count_remaining_messages(user_id=user_id, model=model)
-        sub_limits = self._get_limits()
+        remaining_count = await asyncio.to_thread(self._count_remaining_messages, user_id=user_id, model=model)
         content = START_TEMPLATE.format(
-            model=model, message_count=remaining_count, sub_limits=sub_limits, contact_username=CONTACT_USERNAME
+            model=model, message_count=remaining_count, sub_limits=self.sub_limits, contact_username=CONTACT_USERNAME
         )
         await message.reply(content, parse_mode=ParseMode.MARKDOWN)
 
@@ -296,7 +380,7 @@ class LlmBot:
 
     async def reset(self, message: Message) -> None:
         chat_id = message.chat.id
-        self.db.create_conv_id(chat_id)
+        await asyncio.to_thread(self.db.create_conv_id, chat_id)
         await message.reply(self.localization.RESET)
 
     async def history(self, message: Message) -> None:
@@ -304,27 +388,32 @@ class LlmBot:
         assert message.from_user
         is_chat = chat_id != message.from_user.id
         conv_id = self.db.get_current_conv_id(chat_id)
-        history = self.db.fetch_conversation(conv_id)
+        history = await asyncio.to_thread(self.db.fetch_conversation, conv_id)
         model = self.db.get_current_model(chat_id)
         message_text = self.localization.NO_HISTORY
         if history:
+            await self._wait_for_tokenizer(model)
             history = self._replace_images(history)
             history = self._prepare_history(history, model=model, is_chat=is_chat)
             tokens_count = self._count_tokens(history, model=model)
-            plain_history = json.dumps(history, ensure_ascii=False)
-            plain_history = self._truncate_text(plain_history)
+            raw_history = orjson.dumps(history)
+            if self.chunk_size and len(raw_history) > self.chunk_size:
+                plain_history = raw_history[: self.chunk_size].decode("utf-8", "ignore") + "... truncated"
+            else:
+                plain_history = raw_history.decode("utf-8")
             message_text = self.localization.HISTORY.format(tokens_count=tokens_count, history=plain_history)
         await message.reply(message_text)
 
-    async def _save_chat_message(self, message: Message) -> None:
+    async def _save_chat_message(self, message: Message, content: Union[None, str, List[Dict[str, Any]]]) -> None:
         chat_id = message.chat.id
         assert message.from_user
         user_id = message.from_user.id
         user_name = self._get_user_name(message.from_user)
-        content = await self._build_content(message)
         if content is not None:
             conv_id = self.db.get_current_conv_id(chat_id)
-            self.db.save_user_message(content, conv_id=conv_id, user_id=user_id, user_name=user_name)
+            await asyncio.to_thread(
+                self.db.save_user_message, content, conv_id=conv_id, user_id=user_id, user_name=user_name
+            )
 
     #
     # Выбор модели
@@ -332,7 +421,7 @@ class LlmBot:
 
     @check_admin
     async def set_model(self, message: Message) -> None:
-        await message.reply(self.localization.CHOOSE_MODEL, reply_markup=self.models_kb.as_markup())
+        await message.reply(self.localization.CHOOSE_MODEL, reply_markup=self.models_markup)
 
     @check_admin
     async def set_model_button_handler(self, callback: CallbackQuery) -> None:
@@ -340,7 +429,7 @@ class LlmBot:
         assert callback.data
         chat_id = callback.message.chat.id
         model_name = callback.data.split(":")[1]
-        assert model_name in self.clients
+        assert model_name in self.models
         self.db.set_current_model(chat_id, model_name)
         self.db.create_conv_id(chat_id)
         assert isinstance(callback.message, Message)
@@ -408,7 +497,7 @@ class LlmBot:
 
     @check_admin
     async def set_character(self, message: Message) -> None:
-        await message.reply(self.localization.CHOOSE_CHARACTER, reply_markup=self.characters_kb.as_markup())
+        await message.reply(self.localization.CHOOSE_CHARACTER, reply_markup=self.characters_markup)
 
     @check_admin
     async def set_character_button_handler(self, callback: CallbackQuery) -> None:
@@ -435,8 +524,9 @@ class LlmBot:
     def _count_remaining_messages(self, user_id: int, model: str) -> int:
         is_subscribed = self.db.is_subscribed_user(user_id)
         mode = "standard" if not is_subscribed else "subscribed"
-        limit = int(self.limits[model][mode]["limit"])
-        interval = self.limits[model][mode]["interval"]
+        limits = self.models[model].limits[mode]
+        limit = int(limits["limit"])
+        interval = limits["interval"]
         count = int(self.db.count_user_messages(user_id, model, interval))
         remaining_count = limit - count
         return max(0, remaining_count)
@@ -446,7 +536,7 @@ class LlmBot:
         user_id = message.from_user.id
         chat_id = message.chat.id
         model = self.db.get_current_model(chat_id)
-        remaining_count = self._count_remaining_messages(user_id=user_id, model=model)
+        remaining_count = await asyncio.to_thread(self._count_remaining_messages, user_id=user_id, model=model)
         text = self.localization.REMAINING_MESSAGES.format(model=model, remaining_count=remaining_count)
         await message.reply(text)
 
@@ -463,9 +553,9 @@ class LlmBot:
         template = "- *{model}*: {count} сообщений каждые {hours} часа"
         sub_limits = [
             template.format(
-                model=model, count=limit["subscribed"]["limit"], hours=limit["subscribed"]["interval"] // 3600
+                model=model, count=cfg.limits["subscribed"]["limit"], hours=cfg.limits["subscribed"]["interval"] // 3600
             )
-            for model, limit in self.limits.items()
+            for model, cfg in self.models.items()
         ]
         return "\n".join(sub_limits)
 
@@ -488,9 +578,7 @@ class LlmBot:
             await message.reply(f"У вас уже есть подписка! Она закончится через {remaining_seconds//3600}ч")
             return
 
-        sub_limits = self._get_limits()
-        description = SUB_DESCRIPTION.format(sub_limits=sub_limits, price=SUB_PRICE)
-        await message.reply(description, parse_mode=ParseMode.MARKDOWN, reply_markup=self.buy_kb.as_markup())
+        await message.reply(self.sub_description, parse_mode=ParseMode.MARKDOWN, reply_markup=self.buy_markup)
 
     async def yookassa_sub_buy_proceed(self, callback: CallbackQuery) -> None:
         assert self.yookassa
@@ -549,10 +637,9 @@ class LlmBot:
                 await self.bot.send_message(chat_id=payment.chat_id, text="Платёж отменён!")
                 self.db.set_payment_status(payment.payment_id, status=status.value, internal_status="completed")
 
-    async def set_email(self, message: Message) -> None:
-        assert message.text
+    async def set_email(self, message: Message, command: CommandObject) -> None:
         assert message.from_user
-        email = message.text.replace("/setemail", "").strip()
+        email = command.args.strip() if command.args else ""
         is_valid = "@" in parseaddr(email)[1]
         if not is_valid:
             await message.reply("Некорректный e-mail!")
@@ -566,7 +653,7 @@ class LlmBot:
 
     @check_admin
     async def set_temperature(self, message: Message) -> None:
-        await message.reply("Выберите температуру:", reply_markup=self.temperature_kb.as_markup())
+        await message.reply("Выберите температуру:", reply_markup=self.temperature_markup)
 
     @check_admin
     async def set_temperature_button_handler(self, callback: CallbackQuery) -> None:
@@ -580,7 +667,7 @@ class LlmBot:
 
     @check_admin
     async def set_top_p(self, message: Message) -> None:
-        await message.reply("Выберите top-p:", reply_markup=self.top_p_kb.as_markup())
+        await message.reply("Выберите top-p:", reply_markup=self.top_p_markup)
 
     @check_admin
     async def set_top_p_button_handler(self, callback: CallbackQuery) -> None:
@@ -595,7 +682,7 @@ class LlmBot:
     async def get_params(self, message: Message) -> None:
         chat_id = message.chat.id
         params = self.db.get_parameters(chat_id, self.default_params)
-        await message.reply(f"Текущие параметры генерации: {json.dumps(params)}")
+        await message.reply(f"Текущие параметры генерации: {orjson.dumps(params).decode()}")
 
     #
     # Инструменты
@@ -603,14 +690,14 @@ class LlmBot:
 
     def _get_tools(self, chat_id: int) -> Optional[List[Dict[str, Any]]]:
         model = self.db.get_current_model(chat_id)
-        if self.can_handle_tools[model] and self.tools and self.db.are_tools_enabled(chat_id):
+        if self.models[model].can_handle_tools and self.tools and self.db.are_tools_enabled(chat_id):
             return [t.get_specification() for t in self.tools.values()]
         return None
 
     async def toogle_tools(self, message: Message) -> None:
         chat_id = message.chat.id
         model = self.db.get_current_model(chat_id)
-        if not self.can_handle_tools[model]:
+        if not self.models[model].can_handle_tools:
             await message.reply(f"Для модели {model} инструменты недоступны.")
             return
         current_value = self.db.are_tools_enabled(chat_id)
@@ -621,14 +708,14 @@ class LlmBot:
             await message.reply("Инструменты выключены! Чтобы включить их назад, снова наберите /tools")
 
     async def _check_tools(self, messages: ChatMessages, model: str) -> Any:
-        messages = copy.deepcopy(messages)
         messages = self._replace_images(messages)
         messages = self._fix_broken_tool_calls(messages)
         tools = [t.get_specification() for t in self.tools.values()]
         casted_messages = [cast(ChatCompletionMessageParam, message) for message in messages]
         casted_tools = [cast(ChatCompletionToolParam, tool) for tool in tools]
-        chat_completion = await self.clients[model].chat.completions.create(
-            model=self.model_names[model],
+        cfg = self.models[model]
+        chat_completion = await cfg.client.chat.completions.create(
+            model=cfg.name,
             messages=casted_messages,
             tools=casted_tools,
             tool_choice="auto",
@@ -638,7 +725,7 @@ class LlmBot:
         return response_message
 
     async def _call_dalle(self, conv_id: str, user_id: int, chat_id: int, placeholder: Message, **kwargs: Any) -> None:
-        dalle_count = self.db.count_generated_images(user_id, 86400)
+        dalle_count = await asyncio.to_thread(self.db.count_generated_images, user_id, 86400)
         is_dalle_remaining = DALLE_DAILY_LIMIT - dalle_count > 0
         if not is_dalle_remaining:
             await placeholder.edit_text("Лимит по генерации картинок исчерпан, восстановится через 24 часа")
@@ -651,7 +738,8 @@ class LlmBot:
             new_message = await self.bot.send_message(
                 chat_id=chat_id, reply_to_message_id=placeholder.message_id, text=text
             )
-            self.db.save_assistant_message(
+            await asyncio.to_thread(
+                self.db.save_assistant_message,
                 content=text,
                 conv_id=conv_id,
                 message_id=new_message.message_id,
@@ -661,12 +749,13 @@ class LlmBot:
             return
         image_url: Any = function_response[1]["image_url"]
         base64_image = image_url["url"].replace("data:image/jpeg;base64,", "")
-        image_data = base64.b64decode(base64_image)
+        image_data = pybase64.b64decode(base64_image)
         input_file = BufferedInputFile(image_data, filename="image.jpeg")
         new_message = await self.bot.send_photo(
             chat_id=chat_id, photo=input_file, reply_to_message_id=placeholder.message_id
         )
-        self.db.save_assistant_message(
+        await asyncio.to_thread(
+            self.db.save_assistant_message,
             content=function_response,
             conv_id=conv_id,
             message_id=new_message.message_id,
@@ -675,8 +764,18 @@ class LlmBot:
         )
 
     async def _call_tools(
-        self, history: ChatMessages, model: str, conv_id: str, user_id: int, chat_id: int, placeholder: Message
+        self,
+        history: ChatMessages,
+        model: str,
+        conv_id: str,
+        user_id: int,
+        chat_id: int,
+        placeholder: Message,
+        user_text: Optional[str] = None,
     ) -> Optional[ChatMessages]:
+        if user_text is not None and NO_TOOLS_MESSAGE_RE.match(user_text):
+            return history
+
         response_message = await self._check_tools(history, model=model)
         tool_calls = response_message.tool_calls
         if not tool_calls:
@@ -685,7 +784,9 @@ class LlmBot:
         tool_calls_dict = [c.to_dict() for c in tool_calls]
         response_message = {"content": None, "role": "assistant", "tool_calls": tool_calls_dict}
         history.append(response_message)
-        self.db.save_tool_calls_message(conv_id=conv_id, model=model, tool_calls=tool_calls_dict)
+        await asyncio.to_thread(
+            self.db.save_tool_calls_message, conv_id=conv_id, model=model, tool_calls=tool_calls_dict
+        )
 
         for tool_call in tool_calls:
             function_name = tool_call.function.name
@@ -694,8 +795,8 @@ class LlmBot:
 
             function_response: Union[str, List[Dict[str, Any]], None] = None
             try:
-                function_args = json.loads(tool_call.function.arguments)
-            except json.decoder.JSONDecodeError:
+                function_args = orjson.loads(tool_call.function.arguments)
+            except orjson.JSONDecodeError:
                 function_response = "No response from the tool, try again"
                 print(f"Bad tool answer: {tool_call.function.arguments}")
 
@@ -720,7 +821,8 @@ class LlmBot:
                     "content": function_response,
                 }
             )
-            self.db.save_tool_answer_message(
+            await asyncio.to_thread(
+                self.db.save_tool_answer_message,
                 tool_call_id=tool_call.id,
                 content=function_response,
                 conv_id=conv_id,
@@ -739,6 +841,7 @@ class LlmBot:
         user_name = self._get_user_name(message.from_user)
         chat_id = user_id
         is_chat = False
+        content = await self._build_content(message)
         if message.chat.type in ("group", "supergroup"):
             chat_id = message.chat.id
             is_chat = True
@@ -749,19 +852,24 @@ class LlmBot:
                 and message.reply_to_message.from_user.id == self.bot_info.id
             )
             bot_short_name = self.db.get_short_name(chat_id)
-            assert self.bot_info.username
-            bot_names = ["@" + self.bot_info.username, bot_short_name]
+            assert self.bot_mention
+            bot_names = (self.bot_mention, bot_short_name)
             is_explicit = message.text and any(bot_name in message.text for bot_name in bot_names)
             if not is_reply and not is_explicit:
-                await self._save_chat_message(message)
+                await self._save_chat_message(message, content)
                 return
 
         model = self.db.get_current_model(chat_id)
-        if model not in self.clients:
+        cfg = self.models.get(model)
+        if cfg is None:
             await message.reply("Выбранная модель больше не поддерживается, переключите на другую с помощью /setmodel")
             return
 
-        remaining_count = self._count_remaining_messages(user_id=user_id, model=model)
+        conv_id = self.db.get_current_conv_id(chat_id)
+        remaining_count, history = await asyncio.gather(
+            asyncio.to_thread(self._count_remaining_messages, user_id=user_id, model=model),
+            asyncio.to_thread(self.db.fetch_conversation, conv_id),
+        )
         print(user_id, model, remaining_count)
         if remaining_count <= 0:
             await message.reply(
@@ -775,28 +883,31 @@ class LlmBot:
             await message.reply("Claude не поддерживает температуру выше 1, задайте новую с помощью /settemperature")
             return
 
-        conv_id = self.db.get_current_conv_id(chat_id)
-        history = self.db.fetch_conversation(conv_id)
         system_prompt = self.db.get_system_prompt(chat_id, self.default_prompts)
 
-        content = await self._build_content(message)
-        if not isinstance(content, str) and not self.can_handle_images[model]:
+        if not isinstance(content, str) and not cfg.can_handle_images:
             await message.reply("Выбранная модель не может обработать ваше сообщение")
             return
         if content is None:
             await message.reply("Такой тип сообщений (ещё) не поддерживается")
             return
 
-        self.db.save_user_message(content, conv_id=conv_id, user_id=user_id, user_name=user_name)
-
-        history = history + [{"role": "user", "content": content, "user_name": user_name}]
-        history = self._prepare_history(history, model=model, is_chat=is_chat)
+        placeholder_task = asyncio.create_task(message.reply("💬").emit(self.bot))
+        try:
+            await asyncio.to_thread(
+                self.db.save_user_message, content, conv_id=conv_id, user_id=user_id, user_name=user_name
+            )
 
-        placeholder = await message.reply("💬")
+            history = history + [{"role": "user", "content": content, "user_name": user_name}]
+            await self._wait_for_tokenizer(model)
+            history = self._prepare_history(history, model=model, is_chat=is_chat)
 
-        try:
             tools = self._get_tools(chat_id)
             if tools:
+                user_text = None
+                if isinstance(content, str):
+                    user_text = content.replace(self.db.get_short_name(chat_id), "")
+                placeholder = await placeholder_task
                 response = await self._call_tools(
                     history=history,
                     model=model,
@@ -804,6 +915,7 @@ class LlmBot:
                     conv_id=conv_id,
                     chat_id=chat_id,
                     placeholder=placeholder,
+                    user_text=user_text,
                 )
                 if response is None:
                     return
@@ -813,27 +925,28 @@ class LlmBot:
             history = self._fix_broken_tool_calls(history)
             if tools and "gpt" not in model:
                 params["tools"] = tools
-            answer = await self._query_api(model=model, messages=history, system_prompt=system_prompt, **params)
-
-            chunk_size = self.chunk_size
-            if chunk_size is not None:
-                answer_parts = [answer[i : i + chunk_size] for i in range(0, len(answer), chunk_size)]
-            else:
-                answer_parts = [answer]
-
-            new_message = await placeholder.edit_text(answer_parts[0])
-            assert isinstance(new_message, Message)
-            for part in answer_parts[1:]:
-                new_message = await message.reply(part)
-                assert isinstance(new_message, Message)
-
-            markup = self.likes_kb.as_markup()
-            new_message = await new_message.edit_text(
-                answer_parts[-1],
-                reply_markup=markup,
+            stream_placeholder = await placeholder_task if cfg.can_stream else None
+            answer = await self._query_api(
+                model=model, messages=history, system_prompt=system_prompt, placeholder=stream_placeholder, **params
             )
+            placeholder = await placeholder_task
+
+            chunk_size = self.chunk_size if self.chunk_size is not None else len(answer)
+            parts = self._split_answer(answer, chunk_size)
+            part = next(parts, None)
+            is_first_part = True
+            while part is not None:
+                next_part = next(parts, None)
+                markup = self.likes_markup if next_part is None else None
+                if is_first_part:
+                    new_message = await placeholder.edit_text(part, reply_markup=markup)
+                else:
+                    new_message = await message.reply(part, reply_markup=markup)
+                part = next_part
+                is_first_part = False
             assert isinstance(new_message, Message)
-            self.db.save_assistant_message(
+            await asyncio.to_thread(
+                self.db.save_assistant_message,
                 content=answer,
                 conv_id=conv_id,
                 message_id=new_message.message_id,
@@ -846,12 +959,23 @@ class LlmBot:
             traceback.print_exc()
             text = "Что-то пошло не так, ответ от Сайги не получен или не смог отобразиться."
             text += f" Попробуйте сделать /reset и пришлите @{CONTACT_USERNAME} вот это число: {chat_id}"
+            placeholder = await placeholder_task
             await placeholder.edit_text(text)
 
-    async def _query_api(self, model: str, messages: ChatMessages, system_prompt: str, **kwargs: Any) -> str:
+    async def _query_api(
+        self,
+        model: str,
+        messages: ChatMessages,
+        system_prompt: str,
+        placeholder: Optional[Message] = None,
+        **kwargs: Any,
+    ) -> str:
         assert messages
+        cfg = self.models[model]
         if messages[0]["role"] != "system" and system_prompt.strip():
             messages.insert(0, {"role": "system", "content": system_prompt})
+        if cfg.supports_prompt_cache:
+            messages = self._add_cache_control(messages)
 
         print(
             model,
@@ -861,13 +985,16 @@ class LlmBot:
             self._crop_content(messages[-1]["content"]),
         )
         casted_messages = [cast(ChatCompletionMessageParam, message) for message in messages]
-        chat_completion = await self.clients[model].chat.completions.create(
-            model=self.model_names[model], messages=casted_messages, **kwargs
-        )
-        assert chat_completion.choices, str(chat_completion)
-        assert chat_completion.choices[0].message.content, str(chat_completion)
-        assert isinstance(chat_completion.choices[0].message.content, str), str(chat_completion)
-        answer: str = chat_completion.choices[0].message.content
+        if placeholder is not None:
+            answer = await self._stream_api(model=model, messages=casted_messages, placeholder=placeholder, **kwargs)
+        else:
+            chat_completion = await cfg.client.chat.completions.create(
+                model=cfg.name, messages=casted_messages, **kwargs
+            )
+            assert chat_completion.choices, str(chat_completion)
+            assert chat_completion.choices[0].message.content, str(chat_completion)
+            assert isinstance(chat_completion.choices[0].message.content, str), str(chat_completion)
+            answer = chat_completion.choices[0].message.content
         print(
             model,
             "####",
@@ -879,6 +1006,45 @@ class LlmBot:
         )
         return answer
 
+    async def _stream_api(
+        self, model: str, messages: List[ChatCompletionMessageParam], placeholder: Message, **kwargs: Any
+    ) -> str:
+        cfg = self.models[model]
+        stream = await cfg.client.chat.completions.create(model=cfg.name, messages=messages, stream=True, **kwargs)
+        is_chat = placeholder.chat.type in ("group", "supergroup")
+        edit_interval = STREAM_CHAT_EDIT_INTERVAL if is_chat else STREAM_EDIT_INTERVAL
+        fragments: List[str] = []
+        shown_text = ""
+        next_edit_time = time.monotonic() + edit_interval
+        retry_time = 0.0
+        async with stream:
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                fragments.append(chunk.choices[0].delta.content)
+                if time.monotonic() < next_edit_time:
+                    continue
+                text = "".join(fragments)
+                if self.chunk_size is not None:
+                    text = text[: self.chunk_size - len(STREAM_CURSOR)]
+                if not text.strip() or text == shown_text:
+                    continue
+                next_edit_time = time.monotonic() + edit_interval
+                try:
+                    await placeholder.edit_text(text + STREAM_CURSOR)
+                    shown_text = text
+                except TelegramRetryAfter as e:
+                    retry_time = time.monotonic() + e.retry_after
+                    next_edit_time = retry_time
+                except TelegramAPIError:
+                    traceback.print_exc()
+        retry_delay = retry_time - time.monotonic()
+        if retry_delay > 0:
+            await asyncio.sleep(retry_delay)
+        answer = "".join(fragments)
+        assert answer, "Empty streamed answer"
+        return answer
+
     async def _build_content(self, message: Message) -> Union[None, str, List[Dict[str, Any]]]:
         content_type = message.content_type
         if content_type == "text":
@@ -886,13 +1052,12 @@ class LlmBot:
             text = message.text
             chat_id = message.chat.id
             bot_short_name = self.db.get_short_name(chat_id)
-            assert self.bot_info
-            assert self.bot_info.username
-            text = text.replace("@" + self.bot_info.username, bot_short_name).strip()
+            assert self.bot_mention
+            text = text.replace(self.bot_mention, bot_short_name).strip()
             return text
 
         photo = None
-        photo_ext = (".jpg", "jpeg", ".png", ".webp", ".gif")
+        mime_type = "image/jpeg"
         if content_type == "photo":
             assert message.photo
             file_info = await self.bot.get_file(message.photo[-1].file_id)
@@ -903,22 +1068,24 @@ class LlmBot:
                 file_info = await self.bot.get_file(document.file_id)
                 if file_info and file_info.file_path:
                     file_path = file_info.file_path
-                    if "." + file_path.split(".")[-1].lower() in photo_ext:
+                    ext = os.path.splitext(file_path)[1].lower()
+                    if ext in IMAGE_MIME_TYPES:
                         photo = file_path
+                        mime_type = IMAGE_MIME_TYPES[ext]
 
         if photo:
             file_stream = await self.bot.download_file(photo)
-            assert file_stream
-            file_stream.seek(0)
-            base64_image = base64.b64encode(file_stream.read()).decode("utf-8")
+            assert isinstance(file_stream, io.BytesIO)
+            base64_image = await asyncio.to_thread(pybase64.b64encode, file_stream.getbuffer())
             assert base64_image
+            image_url = b"data:" + mime_type.encode("ascii") + b";base64," + base64_image
             content: List[Dict[str, Any]] = []
             if message.caption:
                 content.append({"type": "text", "text": message.caption})
             content.append(
                 {
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
+                    "image_url": {"url": image_url.decode("ascii")},
                 }
             )
             return content
@@ -936,34 +1103,135 @@ class LlmBot:
         user_id = callback.from_user.id
         message_id = callback.message.message_id
         feedback = callback.data.split(":")[1]
-        self.db.save_feedback(feedback, user_id=user_id, message_id=message_id)
+        await asyncio.to_thread(self.db.save_feedback, feedback, user_id=user_id, message_id=message_id)
         await self.bot.edit_message_reply_markup(
             chat_id=callback.message.chat.id, message_id=message_id, reply_markup=None
         )
 
+    async def _wait_for_tokenizer(self, model: str) -> None:
+        model_name = self.models[model].name
+        task = self.tokenizer_tasks.get(model_name)
+        if task is None:
+            return
+        await asyncio.wait([task])
+        task = self.tokenizer_tasks[model_name]
+        if task.done() and (task.cancelled() or task.exception() is not None):
+            task = self._load_tokenizer(model_name)
+        await task
+
+    def _load_tokenizer(self, model_name: str) -> asyncio.Task[Any]:
+        task = asyncio.create_task(asyncio.to_thread(Tokenizer.get, model_name))
+        task.add_done_callback(self._log_task_exception)
+        self.tokenizer_tasks[model_name] = task
+        return task
+
+    @staticmethod
+    def _log_task_exception(task: asyncio.Task[Any]) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            traceback.print_exception(task.exception())
+
     def _count_tokens(self, messages: ChatMessages, model: str) -> int:
-        url = str(self.clients[model].base_url)
-        tokens_count = 0
+        return sum(self._count_tokens_per_message(messages, model=model))
 
+    def _count_tokens_per_message(self, messages: ChatMessages, model: str) -> List[int]:
+        return self.models[model].token_counter(messages)
+
+    def _build_token_counter(self, url: str, model_name: str) -> TokenCounter:
         if "api.openai.com" in url:
-            encoding = tiktoken.encoding_for_model(self.model_names[model])
-            for m in messages:
-                if isinstance(m["content"], str):
-                    tokens_count += len(encoding.encode(m["content"]))
-                elif self._is_image_content(m["content"]):
-                    tokens_count += 1000
-            return tokens_count
+
+            def count_openai_tokens(texts: List[str]) -> List[int]:
+                encoding = Tokenizer.get_encoding(model_name)
+                batch = encoding.encode_ordinary_batch(texts, num_threads=TOKENIZER_NUM_THREADS)
+                return [len(tokens) for tokens in batch]
+
+            return partial(
+                self._count_message_tokens,
+                count_texts=self._cache_token_counts(count_openai_tokens),
+                image_tokens_count=1000,
+            )
 
         if "anthropic" in url:
-            for m in messages:
-                if isinstance(m["content"], str):
-                    tokens_count += len(m["content"]) // 2
-            return tokens_count
 
-        tokenizer = Tokenizer.get(self.model_names[model])
-        tokens = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
-        tokens_count = len(tokens)
-        return tokens_count
+            def count_anthropic_tokens(texts: List[str]) -> List[int]:
+                return [len(text) // 2 for text in texts]
+
+            return partial(self._count_message_tokens, count_texts=count_anthropic_tokens)
+
+        self.hf_model_names.add(model_name)
+
+        def count_hf_tokens(texts: List[str]) -> List[int]:
+            tokenizer = Tokenizer.get(model_name)
+            backend_tokenizer = getattr(tokenizer, "backend_tokenizer", None)
+            if backend_tokenizer is not None:
+                batch = backend_tokenizer.encode_batch(texts, add_special_tokens=False)
+                return [len(encoding.ids) for encoding in batch]
+            input_ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+            return [len(ids) for ids in input_ids]
+
+        return partial(
+            self._count_message_tokens,
+            count_texts=self._cache_token_counts(count_hf_tokens),
+            message_tokens_overhead=HF_MESSAGE_TOKENS_OVERHEAD,
+        )
+
+    def _count_message_tokens(
+        self,
+        messages: ChatMessages,
+        count_texts: TextsTokenCounter,
+        image_tokens_count: int = 0,
+        message_tokens_overhead: int = 0,
+    ) -> List[int]:
+        texts = [m["content"] for m in messages if isinstance(m["content"], str)]
+        text_counts = count_texts(texts) if texts else []
+
+        counts = []
+        text_counts_iter = iter(text_counts)
+        for m in messages:
+            tokens_count = message_tokens_overhead
+            if isinstance(m["content"], str):
+                tokens_count += next(text_counts_iter)
+            elif self._is_image_content(m["content"]):
+                tokens_count += image_tokens_count
+            counts.append(tokens_count)
+        return counts
+
+    @staticmethod
+    def _cache_token_counts(count_texts: TextsTokenCounter) -> TextsTokenCounter:
+        cache: OrderedDict[Tuple[int, int], int] = OrderedDict()
+
+        def count_texts_cached(texts: List[str]) -> List[int]:
+            keys = [(len(text), hash(text)) for text in texts]
+            missing = {key: text for key, text in zip(keys, texts) if key not in cache}
+            if missing:
+                cache.update(zip(missing.keys(), count_texts(list(missing.values()))))
+            counts = []
+            for key in keys:
+                cache.move_to_end(key)
+                counts.append(cache[key])
+            while len(cache) > TOKEN_COUNTS_CACHE_SIZE:
+                cache.popitem(last=False)
+            return counts
+
+        return count_texts_cached
+
+    @staticmethod
+    def _split_answer(answer: str, chunk_size: int) -> Iterator[str]:
+        start = 0
+        while start < len(answer):
+            if answer[start] == "\n":
+                start += 1
+                continue
+            end = min(start + chunk_size, len(answer))
+            next_start = end
+            if end < len(answer):
+                newline_pos = answer.rfind("\n", start + 1, end + 1)
+                if newline_pos > start:
+                    end = newline_pos
+                    next_start = newline_pos + 1
+            part = answer[start:end]
+            if part.strip():
+                yield part
+            start = next_start
 
     async def _is_admin(self, user_id: int, chat_id: int) -> bool:
         chat_member = await self.bot.get_chat_member(chat_id, user_id)
@@ -972,34 +1240,6 @@ class LlmBot:
             ChatMemberStatus.CREATOR,
         ]
 
-    @staticmethod
-    def _merge_messages(messages: ChatMessages) -> ChatMessages:
-        new_messages: ChatMessages = []
-        prev_role = None
-        for m in messages:
-            content = m["content"]
-            role = m["role"]
-            if role == prev_role and role != "tool":
-                is_current_str = isinstance(content, str)
-                is_prev_str = isinstance(new_messages[-1]["content"], str)
-                if is_current_str and is_prev_str:
-                    new_messages[-1]["content"] += "\n\n" + content
-                    continue
-            prev_role = role
-            new_messages.append(m)
-        return new_messages
-
-    @staticmethod
-    def _format_chat(messages: ChatMessages) -> ChatMessages:
-        for m in messages:
-            content = m["content"]
-            role = m["role"]
-            if role == "user" and content is None:
-                continue
-            if role == "user" and isinstance(content, str) and m["user_name"]:
-                m["content"] = "Из чата пишет {}: {}".format(m["user_name"], content)
-        return messages
-
     @staticmethod
     def _fix_broken_tool_calls(messages: ChatMessages) -> ChatMessages:
         clean_messages: ChatMessages = []
@@ -1014,32 +1254,77 @@ class LlmBot:
         return clean_messages
 
     def _prepare_history(self, history: ChatMessages, model: str, is_chat: bool = False) -> ChatMessages:
-        if is_chat:
-            history = self._format_chat(history)
         assert history
-        save_keys = ("content", "role", "tool_calls", "tool_call_id", "name")
-        history = [{k: m[k] for k in save_keys if m.get(k) is not None or k == "content"} for m in history]
-        history = [m for m in history if not self._is_image_content(m["content"]) or self.can_handle_images[model]]
+        history = self._normalize_history(history, model=model, is_chat=is_chat)
         assert history
-        history = [
-            m for m in history if ("tool_calls" not in m and "tool_call_id" not in m) or self.can_handle_tools[model]
-        ]
-        assert history
-        history = self._merge_messages(history)
-        assert history
-        tokens_count = self._count_tokens(history, model=model)
-        while tokens_count > self.history_max_tokens[model] and len(history) >= 3:
-            history = history[2:]
-            tokens_count = self._count_tokens(history, model=model)
+        counts = self._count_tokens_per_message(history, model=model)
+        tokens_count = sum(counts)
+        start = 0
+        history_max_tokens = self.models[model].history_max_tokens
+        while tokens_count > history_max_tokens and len(history) - start >= 3:
+            tokens_count -= counts[start] + counts[start + 1]
+            start += 2
+        history = history[start:]
         assert history
         return history
 
+    def _normalize_history(self, messages: ChatMessages, model: str, is_chat: bool) -> ChatMessages:
+        save_keys = ("content", "role", "tool_calls", "tool_call_id", "name")
+        cfg = self.models[model]
+        can_handle_images = cfg.can_handle_images
+        can_handle_tools = cfg.can_handle_tools
+        new_messages: ChatMessages = []
+        text_parts: List[str] = []
+        prev_role = None
+        for m in messages:
+            content = m["content"]
+            role = m["role"]
+            if not can_handle_images and self._is_image_content(content):
+                continue
+            is_tool_message = m.get("tool_calls") is not None or m.get("tool_call_id") is not None
+            if not can_handle_tools and is_tool_message:
+                continue
+            is_text = isinstance(content, str)
+            if is_chat and role == "user" and is_text and m.get("user_name"):
+                content = "Из чата пишет {}: {}".format(m["user_name"], content)
+            if role == prev_role and role != "tool" and is_text and text_parts:
+                text_parts.append(content)
+                continue
+            if len(text_parts) > 1:
+                new_messages[-1]["content"] = "\n\n".join(text_parts)
+            prev_role = role
+            new_message = {k: m[k] for k in save_keys if m.get(k) is not None}
+            new_message["content"] = content
+            new_messages.append(new_message)
+            text_parts = [content] if is_text else []
+        if len(text_parts) > 1:
+            new_messages[-1]["content"] = "\n\n".join(text_parts)
+        return new_messages
+
+    @staticmethod
+    def _add_cache_control(messages: ChatMessages) -> ChatMessages:
+        breakpoints = {len(messages) - 2}
+        if messages[0]["role"] == "system":
+            breakpoints.add(0)
+        new_messages = list(messages)
+        for i in breakpoints:
+            if i < 0:
+                continue
+            content = messages[i]["content"]
+            if isinstance(content, str) and content:
+                content = [{"type": "text", "text": content}]
+            if not isinstance(content, list) or not content:
+                continue
+            last_part = {**content[-1], "cache_control": {"type": "ephemeral"}}
+            new_messages[i] = {**messages[i], "content": content[:-1] + [last_part]}
+        return new_messages
+
     def _get_user_name(self, user: User) -> str:
         return str(user.full_name) if user.full_name else str(user.username)
 
     def _crop_content(self, content: str) -> str:
         if isinstance(content, str):
-            return content.replace("\n", " ")[:40]
+            return content[:40].translate(NEWLINES_TRANSLATION)
         return IMAGE_PLACEHOLDER
 
     def _is_image_content(self, content: Any) -> bool:
@@ -1052,10 +1337,7 @@ class LlmBot:
         return messages
 
     def _replace_images(self, messages: ChatMessages) -> ChatMessages:
-        for m in messages:
-            if self._is_image_content(m["content"]):
-                m["content"] = IMAGE_PLACEHOLDER
-        return messages
+        return [{**m, "content": IMAGE_PLACEHOLDER} if self._is_image_content(m["content"]) else m for m in messages]
 
     def _truncate_text(self, text: str) -> str:
         if self.chunk_size and len(text) > self.chunk_size:
@@ -1083,7 +1365,7 @@ def main(
         yookassa_config_path=yookassa_config_path,
         localization_config_path=localization_config_path,
     )
-    asyncio.run(bot.start_polling())
+    uvloop.run(bot.start_polling())
 
 
 if __name__ == "__main__":
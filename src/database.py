@@ -1,14 +1,17 @@
 import secrets
-import json
 import copy
-from typing import Optional, List, Any, Dict, Union
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Any, Dict, Union, Callable, TypeVar, cast
 from datetime import datetime, timezone
 
-from sqlalchemy import create_engine, Integer, String, Text, MetaData, func
+import orjson
+from sqlalchemy import create_engine, event, Integer, String, Text, MetaData, func
 from sqlalchemy.orm import DeclarativeBase, sessionmaker, mapped_column, Mapped
 
 
 metadata = MetaData()
+T = TypeVar("T")
 
 DEFAULT_SHORT_NAME = "Сайга"
 DEFAULT_MODEL = "saiga-v6"
@@ -17,6 +20,14 @@ DEFAULT_PARAMS = {
     "top_p": 0.9,
     "max_tokens": 1536,
 }
+CHAT_CACHE_SIZE = 4096
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+)
 
 
 class Base(DeclarativeBase):
@@ -106,8 +117,18 @@ class Email(Base):
 class Database:
     def __init__(self, db_path: str):
         self.engine = create_engine(f"sqlite:///{db_path}")
+        event.listen(self.engine, "connect", self._set_sqlite_pragmas)
         Base.metadata.create_all(self.engine)
         self.Session = sessionmaker(bind=self.engine)
+        self.chat_cache: OrderedDict[int, Dict[str, Any]] = OrderedDict()
+        self.chat_cache_lock = threading.Lock()
+
+    @staticmethod
+    def _set_sqlite_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
 
     @staticmethod
     def get_current_ts() -> int:
@@ -159,9 +180,13 @@ class Database:
             new_conv = Conversation(user_id=user_id, conv_id=conv_id, timestamp=self.get_current_ts())
             session.add(new_conv)
             session.commit()
+        self._invalidate_cache(user_id)
         return conv_id
 
     def get_current_conv_id(self, user_id: int) -> str:
+        return self._get_cached(user_id, "conv_id", lambda: self._fetch_current_conv_id(user_id))
+
+    def _fetch_current_conv_id(self, user_id: int) -> str:
         with self.Session() as session:
             conv = (
                 session.query(Conversation)
@@ -200,6 +225,9 @@ class Database:
             return int(user_id[0])
 
     def get_current_model(self, user_id: int) -> str:
+        return self._get_cached(user_id, "model", lambda: self._fetch_current_model(user_id))
+
+    def _fetch_current_model(self, user_id: int) -> str:
         with self.Session() as session:
             model = session.query(Model).filter(Model.user_id == user_id).first()
             return model.model if model else DEFAULT_MODEL
@@ -212,8 +240,12 @@ class Database:
             else:
                 session.add(Model(user_id=user_id, model=model_name))
             session.commit()
+        self._invalidate_cache(user_id)
 
     def get_current_model_parameters(self, user_id: int) -> Optional[ModelParameters]:
+        return self._get_cached(user_id, "params", lambda: self._fetch_current_model_parameters(user_id))
+
+    def _fetch_current_model_parameters(self, user_id: int) -> Optional[ModelParameters]:
         current_model = self.get_current_model(user_id)
         with self.Session() as session:
             return session.query(ModelParameters).filter_by(user_id=user_id, model=current_model).first()
@@ -234,6 +266,7 @@ class Database:
             else:
                 session.add(ModelParameters(user_id=user_id, model=current_model, prompt=text))
             session.commit()
+        self._invalidate_cache(user_id)
 
     def get_short_name(self, user_id: int) -> str:
         params = self.get_current_model_parameters(user_id)
@@ -248,6 +281,7 @@ class Database:
             else:
                 session.add(ModelParameters(user_id=user_id, model=current_model, short_name=text))
             session.commit()
+        self._invalidate_cache(user_id)
 
     def set_parameters(self, user_id: int, default_params: Dict[str, Any], **kwargs: Any) -> None:
         current_model = self.get_current_model(user_id)
@@ -256,18 +290,21 @@ class Database:
         with self.Session() as session:
             params = session.query(ModelParameters).filter_by(user_id=user_id, model=current_model).first()
             if params:
-                params.generation_parameters = json.dumps(generation_parameters)
+                params.generation_parameters = orjson.dumps(generation_parameters).decode()
             else:
                 session.add(
-                    ModelParameters(user_id=user_id, model=current_model, generation_parameters=json.dumps(params))
+                    ModelParameters(
+                        user_id=user_id, model=current_model, generation_parameters=orjson.dumps(params).decode()
+                    )
                 )
             session.commit()
+        self._invalidate_cache(user_id)
 
     def get_parameters(self, user_id: int, default_params: Dict[str, Any]) -> Dict[str, Any]:
         current_model = self.get_current_model(user_id)
         params = self.get_current_model_parameters(user_id)
         if params and params.generation_parameters and params.generation_parameters != "null":
-            parsed_params: Dict[str, Any] = json.loads(params.generation_parameters)
+            parsed_params: Dict[str, Any] = orjson.loads(params.generation_parameters)
             return parsed_params
         return copy.deepcopy(default_params.get(current_model, DEFAULT_PARAMS))
 
@@ -284,6 +321,7 @@ class Database:
             else:
                 session.add(ModelParameters(user_id=user_id, model=current_model, enable_tools=value))
             session.commit()
+        self._invalidate_cache(user_id)
 
     def save_user_message(
         self,
@@ -438,21 +476,40 @@ class Database:
             conversations = session.query(Conversation).all()
             return [conv.conv_id for conv in conversations]
 
+    def _get_cached(self, user_id: int, key: str, loader: Callable[[], T]) -> T:
+        with self.chat_cache_lock:
+            cache = self.chat_cache.get(user_id)
+            if cache is None:
+                cache = self.chat_cache[user_id] = dict()
+                if len(self.chat_cache) > CHAT_CACHE_SIZE:
+                    self.chat_cache.popitem(last=False)
+            else:
+                self.chat_cache.move_to_end(user_id)
+            if key in cache:
+                return cast(T, cache[key])
+        value = loader()
+        cache[key] = value
+        return value
+
+    def _invalidate_cache(self, user_id: int) -> None:
+        with self.chat_cache_lock:
+            self.chat_cache.pop(user_id, None)
+
     def _serialize_content(self, content: Union[None, str, List[Dict[str, Any]]]) -> str:
         if isinstance(content, str):
             return content
-        return json.dumps(content)
+        return orjson.dumps(content).decode()
 
     def _parse_content(self, content: Any) -> Any:
         try:
             if content is None:
                 return None
-            parsed_content = json.loads(content)
+            parsed_content = orjson.loads(content)
             if not isinstance(parsed_content, list):
                 return content
             for m in parsed_content:
                 if not isinstance(m, dict):
                     return content
             return parsed_content
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             return content
@@ -1,8 +1,8 @@
-import base64
 import json
 from typing import List, Any, Dict, Union
 
-import requests
+import httpx
+import pybase64
 from openai import AsyncOpenAI, BadRequestError
 
 from src.tools.base import Tool
@@ -12,6 +12,7 @@ from src.tools.base import Tool
 class DalleTool(Tool):
     def __init__(self, **kwargs: Any):
         self.client = AsyncOpenAI(**kwargs)
+        self.http_client = httpx.AsyncClient(http2=True, timeout=30)
 
     def get_specification(self) -> Dict[str, Any]:
         return {
@@ -54,7 +55,7 @@ class DalleTool(Tool):
             return json.dumps(e.response.json()["error"]["message"])
         image_url = response.data[0].url
         assert image_url
-        encoded_image = self.encode_image(image_url)
+        encoded_image = await self.encode_image(image_url)
         content: List[Dict[str, Any]] = [
             {"type": "text", "text": prompt_russian},
             {
@@ -64,9 +65,9 @@ class DalleTool(Tool):
         ]
         return content
 
-    def encode_image(self, image_url: str) -> str:
-        response = requests.get(image_url)
+    async def encode_image(self, image_url: str) -> str:
+        response = await self.http_client.get(image_url)
         response.raise_for_status()
         image_data = response.content
-        encoded_image = base64.b64encode(image_data).decode("utf-8")
+        encoded_image = pybase64.b64encode(image_data).decode("utf-8")
         return encoded_image